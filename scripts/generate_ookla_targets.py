@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import json, os, socket, sys
+import asyncio, json, os, socket, sys
+import orjson
 from urllib.request import Request, urlopen
 
 OOKLA_API = "https://www.speedtest.net/api/js/servers?engine=js&search=Japan&limit=100"
@@ -14,17 +15,20 @@ def strip_port(hostport: str) -> str:
     # e.g. "host.example.net:8080" -> "host.example.net"
     return hostport.rsplit(":", 1)[0]
 
-def resolve_addrs(host: str):
+async def resolve_addrs(host: str):
+    # AF_UNSPEC なら 1 回の問い合わせで両ファミリが返る
     v4, v6 = set(), set()
-    for fam in (socket.AF_INET, socket.AF_INET6):
-        try:
-            infos = socket.getaddrinfo(host, None, fam, socket.SOCK_STREAM)
-            for info in infos:
-                ip = info[4][0]
-                (v4 if fam == socket.AF_INET else v6).add(ip)
-        except socket.gaierror:
-            # 無視（片系のみ解決できないケースあり）
-            pass
+    loop = asyncio.get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(
+            host, None, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM
+        )
+    except socket.gaierror:
+        # 無視（解決できないホストあり）
+        return [], []
+    for info in infos:
+        ip = info[4][0]
+        (v4 if info[0] == socket.AF_INET else v6).add(ip)
     return sorted(v4), sorted(v6)
 
 def make_group(targets, labels):
@@ -45,24 +49,28 @@ def sort_groups(groups):
         )
     return sorted(groups, key=key)
 
-def main():
+async def main():
     os.makedirs(OUT_DIR, exist_ok=True)
     data = fetch_json(OOKLA_API)
 
     icmp_v4, icmp_v6 = [], []
 
-    for item in data:
-        # Japan 以外は除外
-        if item.get("country") != "Japan":
-            continue
+    # Japan のサーバーだけを対象にする
+    items = [
+        item for item in data
+        if item.get("country") == "Japan" and item.get("host")
+    ]
 
-        host_field = item.get("host")     # 例: "foo.prod.hosts.ooklaserver.net:8080"
-        url = item.get("url") or ""       # 通知用ラベルで使う
-        if not host_field:
-            continue
+    # DNS 解決は getaddrinfo 待ちがほぼ全てなので gather でまとめて並行実行する。
+    # 同一ホスト名は一度だけ引くよう先に重複排除しておく
+    fqdns = sorted({strip_port(item["host"]) for item in items})
+    results = await asyncio.gather(*(resolve_addrs(fqdn) for fqdn in fqdns))
+    resolved = dict(zip(fqdns, results))
 
-        fqdn = strip_port(host_field)
-        v4_list, v6_list = resolve_addrs(fqdn)
+    for item in items:
+        url = item.get("url") or ""       # 通知用ラベルで使う
+        fqdn = strip_port(item["host"])   # 例: "foo.prod.hosts.ooklaserver.net:8080"
+        v4_list, v6_list = resolved[fqdn]
 
         base = {
             "ookla_id": str(item.get("id","")),
@@ -80,9 +88,19 @@ def main():
 
     def dump(name, groups):
         path = os.path.join(OUT_DIR, name)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(sort_groups(groups), f, ensure_ascii=False, indent=2)
-            f.write("\n")
+        # orjson は UTF-8 バイト列を直接返す（ensure_ascii=False 相当）
+        data = orjson.dumps(sort_groups(groups), option=orjson.OPT_INDENT_2) + b"\n"
+        # 内容が前回と同一なら書き直さない
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                if f.read() == data:
+                    return
+        # 同一ディレクトリの一時ファイルに書いてから rename（読み手に
+        # 書きかけのファイルを見せない）
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
 
     dump("ookla_icmp_targets_ipv4.json", icmp_v4)
     dump("ookla_icmp_targets_ipv6.json", icmp_v6)
@@ -93,4 +111,4 @@ def main():
     )
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
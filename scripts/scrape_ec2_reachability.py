@@ -8,12 +8,15 @@ Prometheus HTTP SD 形式の JSON を出力します。
 オプション出力: out/aws/aws-targets-ipv4.json, out/aws/aws-targets-ipv6.json
 """
 
+import asyncio
+import functools
 import json
+import os
 import sys
-import time
 import pathlib
 from typing import List, Dict, Tuple
-import requests
+import aiohttp
+import orjson
 
 BASE_URL  = "http://ec2-reachability.amazonaws.com"
 IPV6_BASE = "http://ipv6.ec2-reachability.amazonaws.com"
@@ -28,36 +31,89 @@ ROOT = pathlib.Path(__file__).resolve().parents[1]
 OUT_DIR = ROOT / "out" / "aws"
 OUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# 条件付き GET 用のキャッシュ（本文 + ETag/Last-Modified）
+CACHE_DIR = ROOT / ".cache"
+
 OUT_ALL = OUT_DIR / "aws-targets.json"
 OUT_V4  = OUT_DIR / "aws-targets-ipv4.json"
 OUT_V6  = OUT_DIR / "aws-targets-ipv6.json"
 
 
-def fetch_json(url: str, retries: int = 3, timeout: int = 20) -> object:
-    ex = None
-    for _ in range(retries):
-        try:
-            r = requests.get(url, headers={"User-Agent": UA}, timeout=timeout)
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            ex = e
-            time.sleep(1.5)
-    raise RuntimeError(f"fetch failed: {url} ({ex})")
+RETRIES = 3
+BACKOFF = 1.5
+
 
+async def fetch_json(session: aiohttp.ClientSession, url: str) -> object:
+    """条件付き GET 付きの取得。
+
+    前回の ETag / Last-Modified を送り、304 ならキャッシュ済み本文を使う
+    （スケジュール実行ではページが変わらない回が大半で、ダウンロードを丸ごと省ける）。
+    aiohttp には urllib3 の Retry 相当が無いので、バックオフ付きの
+    リトライループをここで持つ。
+    """
+    name = url.rsplit("/", 1)[-1]
+    body_path = CACHE_DIR / name
+    meta_path = CACHE_DIR / (name + ".meta")
 
+    headers = {}
+    if body_path.exists() and meta_path.exists():
+        try:
+            meta = json.loads(meta_path.read_bytes())
+        except ValueError:
+            meta = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    last_err = None
+    for attempt in range(RETRIES):
+        if attempt:
+            await asyncio.sleep(BACKOFF * attempt)
+        try:
+            async with session.get(url, headers=headers) as r:
+                if r.status == 304:
+                    return json.loads(body_path.read_bytes())
+                r.raise_for_status()
+                content = await r.read()
+                etag          = r.headers.get("ETag", "")
+                last_modified = r.headers.get("Last-Modified", "")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            last_err = e
+            continue
+
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        body_path.write_bytes(content)
+        meta_path.write_text(json.dumps({
+            "etag":          etag,
+            "last_modified": last_modified,
+        }), encoding="utf-8")
+
+        # UTF-8 のバイト列を直接パースする（文字コード推測を通さない）
+        return json.loads(content)
+
+    raise RuntimeError(f"fetch failed: {url} ({last_err})")
+
+
+@functools.lru_cache(maxsize=512)
 def split_city_country(name: str) -> Tuple[str, str]:
-    """'City, Country' 形式を (city, country) に分割する。"""
+    """'City, Country' 形式を (city, country) に分割する。
+    同じリージョン名が IPv4/IPv6 の両方で出てくるのでキャッシュする。"""
     if "," in name:
         a, b = [t.strip() for t in name.split(",", 1)]
         return a, b
     return name, ""
 
 
-def parse_prefixes(data: List[Dict], regions: Dict, ip_version: str) -> List[Dict]:
+def parse_prefixes(data: List[Dict], regions: Dict, ip_version: str, seen: set) -> List[Tuple]:
     """
     prefixes-ipv4.json / prefixes-ipv6.json の形式:
       [ { "region-code": { "cidr": "ip", ... } }, ... ]
+
+    重複は seen を使ってここで落とす（後段の再走査を不要にするため）。
+    行は (area, region, city, ip, ip_version, labels) のタプルで返し、
+    出力用の dict はシリアライズ直前まで作らない。タプルの先頭 5 要素が
+    そのままソートキーになる。
     """
     out = []
     for obj in data:
@@ -66,66 +122,80 @@ def parse_prefixes(data: List[Dict], regions: Dict, ip_version: str) -> List[Dic
             area    = region_info.get("geo", "")
             city, country = split_city_country(region_info.get("name", region_code))
 
+            # ラベルはリージョンごとに全フィールドが同じなので 1 個の dict を
+            # 共有する（生成物はこの後シリアライズされるだけなので安全）。
+            # 値は intern して同一文字列の重複保持も避ける
+            labels = {
+                "provider":   "aws",
+                "area":       sys.intern(area),
+                "region":     sys.intern(region_code),
+                "city":       sys.intern(city),
+                "country":    sys.intern(country),
+                "ip_version": "6" if ip_version == "v6" else "4",
+                "source":     "ec2-reachability",
+            }
+            ipv = labels["ip_version"]
+
             for _prefix, ip in prefix_map.items():
-                labels = {
-                    "provider":   "aws",
-                    "area":       area,
-                    "region":     region_code,
-                    "city":       city,
-                    "country":    country,
-                    "ip_version": "6" if ip_version == "v6" else "4",
-                    "source":     "ec2-reachability",
-                }
-                out.append({"targets": [ip], "labels": labels})
+                # ラベルは以下のフィールドで一意に決まる
+                key = (ip, region_code, city, country, area, ip_version)
+                if key in seen:
+                    continue
+                seen.add(key)
+                out.append((area, region_code, city, ip, ipv, labels))
     return out
 
 
-def sort_key(g: Dict) -> Tuple:
-    L = g.get("labels", {})
-    return (L.get("area", ""), L.get("region", ""), L.get("city", ""), g["targets"][0], L.get("ip_version", ""))
-
-
-def main():
-    print("[*] Fetching regions metadata…", file=sys.stderr)
-    regions = fetch_json(REGIONS_URL)
-
-    print("[*] Fetching IPv4 data…", file=sys.stderr)
-    v4_data = fetch_json(IPv4_URL)
-
-    print("[*] Fetching IPv6 data…", file=sys.stderr)
-    v6_data = fetch_json(IPv6_URL)
+async def main():
+    print("[*] Fetching regions/IPv4/IPv6 data…", file=sys.stderr)
+    # 3 つのダウンロードは独立なので gather で並行して待ち時間を重ねる
+    timeout = aiohttp.ClientTimeout(total=20)
+    async with aiohttp.ClientSession(headers={"User-Agent": UA}, timeout=timeout) as session:
+        regions, v4_data, v6_data = await asyncio.gather(
+            fetch_json(session, REGIONS_URL),
+            fetch_json(session, IPv4_URL),
+            fetch_json(session, IPv6_URL),
+        )
 
     print("[*] Parsing…", file=sys.stderr)
-    v4 = parse_prefixes(v4_data, regions, ip_version="v4")
-    v6 = parse_prefixes(v6_data, regions, ip_version="v6")
-
-    def dedup(lst: List[Dict]) -> List[Dict]:
-        seen = set()
-        uniq = []
-        for g in lst:
-            key = (tuple(g.get("targets", [])), tuple(sorted(g.get("labels", {}).items())))
-            if key not in seen:
-                seen.add(key)
-                uniq.append(g)
-        return uniq
-
-    v4 = dedup(v4)
-    v6 = dedup(v6)
-
-    all_groups  = sorted(v4 + v6, key=sort_key)
-    v4_sorted   = sorted(v4, key=sort_key)
-    v6_sorted   = sorted(v6, key=sort_key)
+    seen: set = set()
+    rows = parse_prefixes(v4_data, regions, ip_version="v4", seen=seen)
+    rows += parse_prefixes(v6_data, regions, ip_version="v6", seen=seen)
+
+    # タプル比較だけでソートできる（key 関数も dict 参照も通らない）。
+    # seen により (region, ip, ip_version) が一意なので末尾の labels が
+    # 比較されることはない
+    rows.sort()
+
+    # 出力用 dict はここで一度だけ作り、v4/v6 へは同じ dict を振り分ける
+    all_groups: List[Dict] = []
+    v4_sorted:  List[Dict] = []
+    v6_sorted:  List[Dict] = []
+    for _area, _region, _city, ip, ipv, labels in rows:
+        g = {"targets": [ip], "labels": labels}
+        all_groups.append(g)
+        (v4_sorted if ipv == "4" else v6_sorted).append(g)
 
     print(f"[*] IPv4 entries: {len(v4_sorted)}  IPv6 entries: {len(v6_sorted)}  Total: {len(all_groups)}", file=sys.stderr)
 
-    OUT_ALL.write_text(json.dumps(all_groups, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
-    OUT_V4.write_text(json.dumps(v4_sorted,  ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
-    OUT_V6.write_text(json.dumps(v6_sorted,  ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
-
-    print(f"[*] wrote: {OUT_ALL}", file=sys.stderr)
-    print(f"[*] wrote: {OUT_V4}", file=sys.stderr)
-    print(f"[*] wrote: {OUT_V6}", file=sys.stderr)
+    def dump(path: pathlib.Path, groups: List[Dict]) -> None:
+        # orjson は UTF-8 バイト列を直接返す（ensure_ascii=False 相当）
+        data = orjson.dumps(groups, option=orjson.OPT_INDENT_2) + b"\n"
+        # 内容が前回と同一なら書かない（下流の reload / commit を無駄に起こさない）
+        if path.exists() and path.read_bytes() == data:
+            print(f"[*] unchanged: {path}", file=sys.stderr)
+            return
+        # 同一ディレクトリの一時ファイルに書いてから rename（読み手に
+        # 書きかけのファイルを見せない）
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        print(f"[*] wrote: {path}", file=sys.stderr)
+
+    dump(OUT_ALL, all_groups)
+    dump(OUT_V4, v4_sorted)
+    dump(OUT_V6, v6_sorted)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())